@@ -1,12 +1,10 @@
-import io
 import base64
 import numpy as np
 import cv2
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from PIL import Image
-from sklearn.cluster import KMeans, OPTICS
+from sklearn.cluster import OPTICS
 from scipy.spatial.distance import euclidean
 import matplotlib.pyplot as plt
 import streamlit as st
@@ -26,20 +24,39 @@ def preprocess_image(image):
     clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
     return clahe.apply(image)
 
-def enhance_image_kmeans(image, n_clusters=8):
-    pixel_values = image.reshape(-1, 1)
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-    kmeans.fit(pixel_values)
-    labels = kmeans.labels_
-    centers = kmeans.cluster_centers_
-    segmented_pixels = centers[labels].reshape(image.shape)
-    return cv2.normalize(segmented_pixels, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+def assign_bins(centers):
+    mids = (centers[:-1] + centers[1:]) * 0.5
+    return np.searchsorted(mids, np.arange(256))
+
+def kmeans_1d_hist(hist, n_clusters, max_iter=20, tol=1e-3):
+    bins = np.arange(256, dtype=np.float64)
+    cdf = np.cumsum(hist) / hist.sum()
+    centers = np.searchsorted(cdf, (np.arange(n_clusters) + 0.5) / n_clusters).astype(np.float64)
+    for _ in range(max_iter):
+        assign = assign_bins(centers)
+        sums = np.bincount(assign, weights=hist * bins, minlength=n_clusters)
+        counts = np.bincount(assign, weights=hist, minlength=n_clusters)
+        new_centers = np.sort(np.where(counts > 0, sums / np.maximum(counts, 1), centers))
+        converged = np.max(np.abs(new_centers - centers)) < tol
+        centers = new_centers
+        if converged:
+            break
+    return centers, assign_bins(centers)
+
+def cluster_lut(image, n_clusters=8):
+    hist = np.bincount(image.ravel(), minlength=256)
+    centers, assign = kmeans_1d_hist(hist, n_clusters)
+    return np.rint(centers[assign]).astype(np.uint8)
 
 def blend_images(original, clustered, alpha=0.7):
-    original = original.astype(np.float32)
-    clustered = clustered.astype(np.float32)
-    blended = alpha * clustered + (1 - alpha) * original
-    return cv2.normalize(blended, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    return cv2.addWeighted(clustered, alpha, original, 1.0 - alpha, 0.0)
+
+def enhance_and_blend(image, n_clusters=8, alpha=0.7):
+    # Clustering and blending are both per-intensity, so compose them on the
+    # 256-entry tables and touch the full image only once
+    identity = np.arange(256, dtype=np.uint8)
+    fused_lut = blend_images(identity, cluster_lut(image, n_clusters), alpha)
+    return cv2.LUT(image, fused_lut)
 
 def detect_disc_spaces_optics(image):
     if len(image.shape) == 2:
@@ -101,13 +118,12 @@ def detect_disc_spaces_optics(image):
     return spaces, output
 
 def image_to_base64(image_array):
-    buf = io.BytesIO()
-    img = Image.fromarray(image_array)
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    img.save(buf, format='PNG')
-    byte_im = buf.getvalue()
-    return base64.b64encode(byte_im).decode('utf-8')
+    if image_array.ndim == 3:
+        image_array = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
+    ok, buf = cv2.imencode('.png', image_array, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    if not ok:
+        raise ValueError("PNG encoding failed")
+    return base64.b64encode(buf.tobytes()).decode('utf-8')
 
 class AnalyzeResponse(BaseModel):
     original: str
@@ -119,13 +135,12 @@ class AnalyzeResponse(BaseModel):
 @app.post("/analyze", response_model=AnalyzeResponse)
 async def analyze(file: UploadFile = File(...)):
     contents = await file.read()
-    image = Image.open(io.BytesIO(contents)).convert('L')
-    img_array = np.array(image)
+    img_array = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img_array is None:
+        raise HTTPException(status_code=400, detail="Uploaded file is not a readable image")
     processed = preprocess_image(img_array)
-    clustered = enhance_image_kmeans(processed, 8)
-    enhanced = blend_images(processed, clustered)
-    orig_color = np.array(Image.open(io.BytesIO(contents)).convert('RGB'))
-    _, overlaid = detect_disc_spaces_optics(orig_color)
+    enhanced = enhance_and_blend(processed, 8)
+    _, overlaid = detect_disc_spaces_optics(img_array)
     return AnalyzeResponse(
         original=image_to_base64(img_array),
         preprocessed=image_to_base64(processed),
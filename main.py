@@ -1,12 +1,12 @@
 import streamlit as st
 import cv2
 import numpy as np
-from sklearn.cluster import KMeans
-from PIL import Image
 import io
 import zipfile
 import os
 import base64
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 st.set_page_config(page_title="Spinal Cord Image Clustering", layout="wide")
 
@@ -65,11 +65,9 @@ def resize_for_display(image, target_width=400, target_height=400):
     scale = min(target_width/w, target_height/h)
     new_w, new_h = int(w * scale), int(h * scale)
     
-    # Resize the image using high-quality interpolation
-    if len(image.shape) == 2:
-        resized = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LANCZOS4)
-    else:
-        resized = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LANCZOS4)
+    # Area averaging when shrinking (alias-free and cheaper), Lanczos when enlarging
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LANCZOS4
+    resized = cv2.resize(image, (new_w, new_h), interpolation=interpolation)
     
     # Create a canvas of target size and center the resized image
     if len(image.shape) == 2:
@@ -101,7 +99,7 @@ def process_at_original_size(image, max_processing_size=2048):
     if max(h, w) > max_processing_size:
         scale = max_processing_size / max(h, w)
         new_h, new_w = int(h * scale), int(w * scale)
-        return cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LANCZOS4)
+        return cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_AREA)
     
     return image
 
@@ -114,13 +112,22 @@ def resize_image(image, max_size=1000):
         image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_AREA)
     return image
 
+# Cache key over the full pixel content - Streamlit's default ndarray hash only
+# samples large arrays, so same-shape uploads could otherwise share an entry
+def hash_array(array):
+    return (array.shape, array.dtype.str, hashlib.blake2b(array.tobytes(), digest_size=16).digest())
+
+ARRAY_HASH_FUNCS = {np.ndarray: hash_array}
+
 # CLAHE preprocessing - enhanced for quality
+@st.cache_data(max_entries=4, hash_funcs=ARRAY_HASH_FUNCS)
 def preprocess_image(image):
     """Apply CLAHE preprocessing while maintaining image quality"""
     # Ensure we're working with the full resolution image
     image = process_at_original_size(image)
     
     # Apply CLAHE with optimized parameters for medical images
+    # (built per call: CLAHE objects keep internal buffers and are not thread-safe)
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
     processed = clahe.apply(image)
     
@@ -129,34 +136,49 @@ def preprocess_image(image):
     
     return processed
 
-# K-Means enhancement - optimized for quality
-def enhance_image_kmeans(image, n_clusters=8):
-    """Apply K-means clustering while preserving image quality"""
-    # Ensure we're working with full resolution
-    original_shape = image.shape
-    
-    # Reshape for clustering
-    pixel_values = image.reshape(-1, 1).astype(np.float32)
+# Nearest center for each of the 256 intensity bins
+def assign_bins(centers):
+    """Assign every intensity to its nearest center via midpoints of the sorted centers"""
+    # In 1-D the decision boundaries are the midpoints between neighbouring centers
+    mids = (centers[:-1] + centers[1:]) * 0.5
+    return np.searchsorted(mids, np.arange(256))
+
+# 1-D K-Means over the 256-bin grayscale histogram
+def kmeans_1d_hist(hist, n_clusters, max_iter=20, tol=1e-3):
+    """Run weighted Lloyd iterations over the 256 intensity bins instead of every pixel"""
+    bins = np.arange(256, dtype=np.float64)
     
-    # Apply K-means with better initialization
-    kmeans = KMeans(
-        n_clusters=n_clusters,  
-        random_state=42,  
-        init='k-means++',   # Better initialization
-        n_init=10,          # More initializations for stability
-        max_iter=300        # More iterations for convergence
-    )
-    kmeans.fit(pixel_values)
+    # Initialize centers at evenly spaced quantiles of the intensity CDF
+    cdf = np.cumsum(hist) / hist.sum()
+    quantiles = (np.arange(n_clusters) + 0.5) / n_clusters
+    centers = np.searchsorted(cdf, quantiles).astype(np.float64)
     
-    # Get cluster centers and labels
-    labels = kmeans.labels_
-    centers = kmeans.cluster_centers_
+    for _ in range(max_iter):
+        assign = assign_bins(centers)
+        
+        # Weighted per-cluster sums and counts in one vectorized reduction each
+        sums = np.bincount(assign, weights=hist * bins, minlength=n_clusters)
+        counts = np.bincount(assign, weights=hist, minlength=n_clusters)
+        
+        # Empty clusters keep their previous center
+        new_centers = np.sort(np.where(counts > 0, sums / np.maximum(counts, 1), centers))
+        converged = np.max(np.abs(new_centers - centers)) < tol
+        centers = new_centers
+        if converged:
+            break
     
-    # Reconstruct the image
-    segmented_pixels = centers[labels].reshape(original_shape)
+    # Final assignment of every intensity bin to its nearest center
+    return centers, assign_bins(centers)
+
+# K-Means lookup table over grayscale intensities
+def cluster_lut(image, n_clusters=8):
+    """Map each of the 256 intensities to its K-means cluster center"""
+    # Cluster the intensity histogram rather than the full pixel array
+    hist = np.bincount(image.ravel(), minlength=256)
+    centers, assign = kmeans_1d_hist(hist, n_clusters)
     
-    # Normalize to preserve dynamic range
-    return cv2.normalize(segmented_pixels, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    # Centers are means of uint8 values so already in range
+    return np.rint(centers[assign]).astype(np.uint8)
 
 # Image blending - enhanced for quality preservation
 def blend_images(original, clustered, alpha=0.7):
@@ -166,34 +188,56 @@ def blend_images(original, clustered, alpha=0.7):
         clustered = cv2.resize(clustered, (original.shape[1], original.shape[0]), 
                                interpolation=cv2.INTER_LANCZOS4)
     
-    # Convert to float32 for precision
-    original = original.astype(np.float32)
-    clustered = clustered.astype(np.float32)
-    
-    # Perform blending
-    blended = alpha * clustered + (1 - alpha) * original
+    # Single-pass uint8 weighted sum with rounding and saturation
+    return cv2.addWeighted(clustered, alpha, original, 1.0 - alpha, 0.0)
+
+# Clustering and blending in one pass each
+@st.cache_data(max_entries=4, hash_funcs=ARRAY_HASH_FUNCS)
+def enhance_and_blend(image, n_clusters=8, alpha=0.7):
+    """Return the clustered and blended images from a single K-means fit"""
+    # Both steps depend only on pixel intensity, so compose them on the 256-entry tables
+    clustered_lut = cluster_lut(image, n_clusters)
+    blended_lut = blend_images(np.arange(256, dtype=np.uint8), clustered_lut, alpha)
     
-    # Normalize back to uint8 while preserving full dynamic range
-    blended = np.clip(blended, 0, 255)
-    return blended.astype(np.uint8)
+    # Each output is then one table lookup over the full image
+    return cv2.LUT(image, clustered_lut), cv2.LUT(image, blended_lut)
 
 # High-quality image conversion function
-def image_to_bytes(image_array, quality=95):
-    """Convert image array to high-quality PNG bytes"""
+def image_to_bytes(image_array, compression=1):
+    """Convert image array to lossless PNG bytes"""
     # Ensure the image is in uint8 format
     if image_array.dtype != np.uint8:
         image_array = cv2.normalize(image_array, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
     
-    # Convert to PIL Image with high quality settings
-    if len(image_array.shape) == 2:  # Grayscale
-        img = Image.fromarray(image_array, mode='L')
-    else:  # Color
-        img = Image.fromarray(image_array)
+    # OpenCV expects BGR channel order for color images
+    if len(image_array.shape) == 3:
+        image_array = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
     
-    # Save to PNG with maximum quality (lossless compression)
-    buf = io.BytesIO()
-    img.save(buf, format='PNG', optimize=False, compress_level=1)  # Low compression for max quality
-    return buf.getvalue()
+    # Low zlib level: PNG stays lossless, encoding is much cheaper
+    ok, buf = cv2.imencode('.png', image_array, [cv2.IMWRITE_PNG_COMPRESSION, compression])
+    if not ok:
+        raise ValueError("PNG encoding failed")
+    return buf.tobytes()
+
+# Encode every download image exactly once per upload
+@st.cache_data(max_entries=4, hash_funcs=ARRAY_HASH_FUNCS)
+def encode_images(images_dict):
+    """Return PNG bytes for each named image"""
+    # cv2.imencode releases the GIL, so the encodes run concurrently on threads
+    with ThreadPoolExecutor(max_workers=min(len(images_dict), os.cpu_count() or 1)) as executor:
+        futures = {key: executor.submit(image_to_bytes, image) for key, image in images_dict.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+# Bundle already-encoded PNGs into a ZIP archive
+@st.cache_data(max_entries=4)
+def build_zip(images_bytes, filename):
+    """Return ZIP bytes holding one PNG per named image"""
+    zip_buffer = io.BytesIO()
+    # PNG data is already compressed, so store it as-is
+    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zip_file:
+        for key, img_bytes in images_bytes.items():
+            zip_file.writestr(f"{filename}_{key.lower()}.png", img_bytes)
+    return zip_buffer.getvalue()
 
 # Function to convert image array to base64 string for display (if needed)
 def image_to_base64(image_array):
@@ -236,13 +280,11 @@ with main_col:
     st.title("Spinal Cord Image Clustering and Analysis")
 
     if uploaded_file:
-        # Keep original image for display
-        original_image = Image.open(uploaded_file)           # Do NOT convert to grayscale here
-        original_array = np.array(original_image)
-
-        # Convert to grayscale for processing - preserve original resolution
-        gray_image = original_image.convert('L')
-        img_array = np.array(gray_image)
+        # Decode straight to grayscale for processing - preserve original resolution
+        img_array = cv2.imdecode(np.frombuffer(uploaded_file.getvalue(), np.uint8), cv2.IMREAD_GRAYSCALE)
+        if img_array is None:
+            st.error("Could not read the uploaded file as an image. Please upload a valid JPG or PNG.")
+            st.stop()
         
         filename = os.path.splitext(uploaded_file.name)[0]
         
@@ -251,12 +293,11 @@ with main_col:
         
         # Process at full resolution
         processed = preprocess_image(img_array)
-        clustered = enhance_image_kmeans(processed, 8)
-        enhanced = blend_images(processed, clustered)
+        clustered, enhanced = enhance_and_blend(processed, 8)
         
         # Create display versions ONLY for showing on screen
         target_width, target_height = 400, 400
-        original_display = resize_for_display(original_array, target_width, target_height)
+        original_display = resize_for_display(img_array, target_width, target_height)
         processed_display = resize_for_display(processed, target_width, target_height)
         clustered_display = resize_for_display(clustered, target_width, target_height)
         enhanced_display = resize_for_display(enhanced, target_width, target_height)
@@ -273,13 +314,8 @@ with main_col:
             'Enhanced': enhanced             # Full resolution enhanced
         }
         
-        # Prepare ZIP for download
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for key, img_array in images_dict.items():
-                img_bytes = image_to_bytes(img_array)  # Get raw PNG bytes
-                zip_file.writestr(f"{filename}_{key.lower()}.png", img_bytes)
-        zip_buffer.seek(0)
+        # Encode PNGs once and reuse them for the individual and ZIP downloads
+        images_bytes = encode_images(images_dict)
         
         # Display images with consistent sizes
         col1, col2, col3, col4 = st.columns(4)
@@ -297,7 +333,7 @@ with main_col:
         with col1:
             st.download_button(
                 label="Download Original Image",
-                data=image_to_bytes(img_array),
+                data=images_bytes['Original'],
                 file_name=f"{filename}_original.png",
                 mime="image/png",
                 key="download1"
@@ -305,7 +341,7 @@ with main_col:
         with col2:
             st.download_button(
                 label="Download Preprocessed Image",
-                data=image_to_bytes(processed),
+                data=images_bytes['Preprocessed'],
                 file_name=f"{filename}_preprocessed.png",
                 mime="image/png",
                 key="download2"
@@ -313,7 +349,7 @@ with main_col:
         with col3:
             st.download_button(
                 label="Download Clustered Image",
-                data=image_to_bytes(clustered),
+                data=images_bytes['Clustered'],
                 file_name=f"{filename}_clustered.png",
                 mime="image/png",
                 key="download3"
@@ -321,20 +357,23 @@ with main_col:
         with col4:
             st.download_button(
                 label="Download Enhanced Image",
-                data=image_to_bytes(enhanced),
+                data=images_bytes['Enhanced'],
                 file_name=f"{filename}_enhanced.png",
                 mime="image/png",
                 key="download4"
             )
 
-        # Download all images as ZIP
-        st.download_button(
-            label="Download All Images as ZIP",
-            data=zip_buffer,
-            file_name=f"{filename}_images.zip",
-            mime="application/zip",
-            key="download_zip"
-        )
+        # Build the ZIP only once the user asks for it (remembered per upload)
+        if st.button("Prepare ZIP of All Images", key="prepare_zip"):
+            st.session_state.zip_file_id = uploaded_file.file_id
+        if st.session_state.get("zip_file_id") == uploaded_file.file_id:
+            st.download_button(
+                label="Download All Images as ZIP",
+                data=build_zip(images_bytes, filename),
+                file_name=f"{filename}_images.zip",
+                mime="application/zip",
+                key="download_zip"
+            )
 
     else:
         st.info("Please upload a spinal X-ray image to begin analysis")